@@ -57,9 +57,9 @@ class BARRIER:
         self.action_bar = np.resize(self.action_bar, [batch_s, self.action_size])
         self.action_BAR = np.resize(self.action_BAR, [batch_s, self.action_size])
 
-    # Given current observation, get the neural network output (representing barrier compensator)
+    # Given current observation(s), get the neural network output (representing barrier compensator)
     def get_action(self, obs):
-        observation = np.expand_dims(np.squeeze(obs), 0)
+        observation = np.reshape(obs, (-1, self.input_size))
         feed_dict = {self.x: observation}
         u_bar = self.sess.run(self.value, feed_dict)
         return u_bar
@@ -8,7 +8,9 @@ Created on Thu Aug 16 14:17:49 2018
 
 import dynamics_gp
 import numpy as np
+import osqp
 from cvxopt import matrix, solvers
+from scipy import sparse
 
 
 # Build barrier function model
@@ -23,9 +25,21 @@ def build_barrier(self):
     self.H4 = np.array([-1, -0.05])
     self.F = 1
 
+    # OSQP problem with the same cost, set up on the first call to control_barrier
+    # and then only updated in place (and warm-started) at every step
+    self.qp = None
 
-# Get compensatory action based on satisfaction of barrier function
-def control_barrier(self, obs, u_rl, f, g, x, std):
+
+# Store every entry of M so that updates of the values keep the same sparsity pattern
+def dense_csc(M):
+    m, n = M.shape
+    return sparse.csc_matrix(
+        (M.flatten(order="F"), np.tile(np.arange(m), n), np.arange(0, m * n + 1, m)), shape=(m, n)
+    )
+
+
+# Constraints G [u_bar, slack] <= h of the barrier function QP
+def barrier_constraints(self, u_rl, f, g, x, std):
     # Define gamma for the barrier function
     gamma_b = 0.5
 
@@ -69,23 +83,68 @@ def control_barrier(self, obs, u_rl, f, g, x, std):
     tmp2 = [ttt.item() for ttt in tmp]
     h = np.array(tmp2)
     h = np.squeeze(h).astype(np.double)
+    return G, h
 
+
+# Solve the barrier function QP with the interior-point solver
+def solve_barrier_qp_cvxopt(self, G, h):
     # Convert numpy arrays to cvx matrices to set up QP
     G = matrix(G, tc="d")
     h = matrix(h, tc="d")
 
     solvers.options["show_progress"] = False
     sol = solvers.qp(self.P, self.q, G, h)
-    u_bar = sol["x"]
+    return np.array(sol["x"]).flatten()
+
+
+# Get compensatory action based on satisfaction of barrier function
+def control_barrier(self, obs, u_rl, f, g, x, std):
+    G, h = barrier_constraints(self, u_rl, f, g, x, std)
+
+    # Solve the QP G x <= h, reusing the factorization and solution of the previous step
+    if self.qp is None:
+        self.qp = osqp.OSQP()
+        self.qp.setup(
+            P=sparse.csc_matrix(np.array(self.P)),
+            q=np.array(self.q).flatten(),
+            A=dense_csc(G),
+            l=np.full(h.shape, -np.inf),
+            u=h,
+            warm_start=True,
+            polish=True,
+            # Accepted solutions converge within a few warm-started iterations, the rest
+            # go to cvxopt, so do not spend the full ADMM budget on them
+            max_iter=200,
+            eps_abs=1e-6,
+            eps_rel=1e-6,
+            verbose=False,
+        )
+    else:
+        self.qp.update(Ax=G.flatten(order="F"), u=h)
+    res = self.qp.solve()
+
+    # OSQP's relative tolerances are scaled by the 1e24 slack weight, so "solved" alone does not
+    # show that the slack is zero; only take a polished solution that satisfies G x <= h with no slack
+    tol = 1e-6
+    if (
+        res.info.status == "solved"
+        and res.info.status_polish == 1
+        and abs(res.x[1]) <= tol
+        and np.all(np.dot(G, res.x) <= h + tol)
+    ):
+        u_bar = np.array(res.x)
+    else:
+        # Fall back to the interior-point solver otherwise
+        u_bar = solve_barrier_qp_cvxopt(self, G, h)
     # if np.abs(u_bar[1]) > 0.001:
     # print("Violation of Safety: ")
     # print(u_bar[1])
 
     if np.add(np.squeeze(u_rl), np.squeeze(u_bar[0])) - 0.001 >= self.torque_bound:
-        u_bar[0] = self.torque_bound - u_rl
+        u_bar[0] = self.torque_bound - np.squeeze(u_rl)
         print("Error in QP")
     elif np.add(np.squeeze(u_rl), np.squeeze(u_bar[0])) + 0.001 <= -self.torque_bound:
-        u_bar[0] = -self.torque_bound - u_rl
+        u_bar[0] = -self.torque_bound - np.squeeze(u_rl)
         print("Error in QP")
     else:
         pass
@@ -4,10 +4,12 @@ Implementation of DDPG-CBF on the Pendulum-v0 OpenAI gym task
 """
 import argparse
 import datetime
+import functools
 import math
 import os
 import pprint as pp
 import random
+import threading
 from typing import Union
 
 import cbf
@@ -19,14 +21,39 @@ import tflearn
 from barrier_comp import BARRIER
 from gym import spaces, wrappers
 from learner import LEARNER
+from numba import njit
 from replay_buffer import ReplayBuffer
 from scipy.io import savemat
+from tensorflow.tools.graph_transforms import TransformGraph
+from vec_env import SubprocVecEnv
 
 # ===========================
 #   Actor and Critic DNNs
 # ===========================
 
 
+def make_session_callable(sess, fetches, feed_list):
+    """
+    Return a function that runs fetches (a list of tensors and ops) with the
+    tensors of feed_list fed positionally, and returns the values of the
+    tensors in fetches. The feeds and fetches are registered with the runtime
+    once through CallableOptions, so a call skips the feed_dict marshaling and
+    graph lookup of sess.run, which sess.make_callable with a feed list still
+    goes through.
+    """
+    callable_opts = tf.CallableOptions()
+    callable_opts.feed.extend(t.name for t in feed_list)
+    callable_opts.fetch.extend(f.name for f in fetches if isinstance(f, tf.Tensor))
+    callable_opts.target.extend(f.name for f in fetches if isinstance(f, tf.Operation))
+    run = sess._make_callable_from_options(callable_opts)
+    dtypes = [t.dtype.as_numpy_dtype for t in feed_list]
+
+    def call(*feed_values):
+        return run(*[np.asarray(v, dtype=dtype) for v, dtype in zip(feed_values, dtypes)])
+
+    return call
+
+
 class ActorNetwork(object):
     """
     Input to the network is the state, output is the action
@@ -36,88 +63,177 @@ class ActorNetwork(object):
     between -action_bound and action_bound
     """
 
-    def __init__(self, sess, state_dim, action_dim, action_bound, learning_rate, tau, batch_size):
+    def __init__(self, sess, state_dim, action_dim, action_bound, learning_rate, tau):
         self.sess = sess
         self.s_dim = state_dim
         self.a_dim = action_dim
         self.action_bound = action_bound
         self.learning_rate = learning_rate
         self.tau = tau
-        self.batch_size = batch_size
 
         # Actor Network
-        self.inputs, self.out, self.scaled_out = self.create_actor_network()
+        self.inputs, self.out, self.scaled_out, self.hidden_layers = self.create_actor_network()
 
         self.network_params = tf.trainable_variables()
 
         # Target Network
-        self.target_inputs, self.target_out, self.target_scaled_out = self.create_actor_network()
+        self.target_inputs, self.target_out, self.target_scaled_out, _ = self.create_actor_network()
 
         self.target_network_params = tf.trainable_variables()[len(self.network_params) :]
 
         # Op for periodically updating target network with online network
-        # weights
-        self.update_target_network_params = [
-            self.target_network_params[i].assign(
-                tf.multiply(self.network_params[i], self.tau)
-                + tf.multiply(self.target_network_params[i], 1.0 - self.tau)
-            )
-            for i in range(len(self.target_network_params))
-        ]
-
-        # This gradient will be provided by the critic network
-        self.action_gradient = tf.placeholder(tf.float32, [None, self.a_dim])
-
-        # Combine the gradients here
-        self.unnormalized_actor_gradients = tf.gradients(self.scaled_out, self.network_params, -self.action_gradient)
-        self.actor_gradients = list(map(lambda x: tf.div(x, self.batch_size), self.unnormalized_actor_gradients))
-
-        # Optimization Op
-        self.optimize = tf.train.AdamOptimizer(self.learning_rate).apply_gradients(
-            zip(self.actor_gradients, self.network_params)
+        # weights, grouped so that it runs as a single fetch
+        self.update_target_network_params = tf.group(
+            *[
+                target_param.assign_sub(self.tau * (target_param - param))
+                for param, target_param in zip(self.network_params, self.target_network_params)
+            ]
         )
 
+        # The optimization Op is built by create_policy_update once the critic exists
+
         self.num_trainable_vars = len(self.network_params) + len(self.target_network_params)
 
+        # Cached callable; make_callable takes the fast path when nothing is fed.
+        # Rollouts are sampled with a RolloutActor snapshot, not through this network.
+        self._update_target_callable = self.sess.make_callable(self.update_target_network_params)
+
     def create_actor_network(self):
         inputs = tflearn.input_data(shape=[None, self.s_dim])
-        net = tflearn.fully_connected(inputs, 400)
-        net = tflearn.layers.normalization.batch_normalization(net)
-        net = tflearn.activations.relu(net)
-        net = tflearn.fully_connected(net, 300)
-        net = tflearn.layers.normalization.batch_normalization(net)
-        net = tflearn.activations.relu(net)
+        fc1 = tflearn.fully_connected(inputs, 400)
+        bn1 = tflearn.layers.normalization.batch_normalization(fc1)
+        net = tflearn.activations.relu(bn1)
+        fc2 = tflearn.fully_connected(net, 300)
+        bn2 = tflearn.layers.normalization.batch_normalization(fc2)
+        net = tflearn.activations.relu(bn2)
         # Final layer weights are init to Uniform[-3e-3, 3e-3]
         w_init = tflearn.initializations.uniform(minval=-0.003, maxval=0.003)
         out = tflearn.fully_connected(net, self.a_dim, activation="tanh", weights_init=w_init)
         # Scale output to -action_bound to action_bound
         scaled_out = tf.multiply(out, self.action_bound)
-        return inputs, out, scaled_out
-
-    def train(self, inputs, a_gradient):
-        self.sess.run(self.optimize, feed_dict={self.inputs: inputs, self.action_gradient: a_gradient})
+        # (fully connected, batch norm) pairs of the hidden layers, for folding at inference
+        hidden_layers = [(fc1, bn1), (fc2, bn2)]
+        return inputs, out, scaled_out, hidden_layers
+
+    def export_inference_graph(self):
+        """
+        Build a constant GraphDef of the current online actor with each batch
+        normalization folded into the fully connected layer before it.
+        Returns the GraphDef and the names of its input and output ops.
+        """
+        graph = self.sess.graph
+        hidden_params, out_params = self.sess.run(
+            [
+                [
+                    [
+                        fc.W,
+                        fc.b,
+                        bn.gamma,
+                        bn.beta,
+                        graph.get_tensor_by_name(bn.scope.name + "/moving_mean:0"),
+                        graph.get_tensor_by_name(bn.scope.name + "/moving_variance:0"),
+                    ]
+                    for fc, bn in self.hidden_layers
+                ],
+                [self.out.W, self.out.b],
+            ]
+        )
 
-    def predict(self, inputs):
-        return self.sess.run(self.scaled_out, feed_dict={self.inputs: inputs})
+        inference_graph = tf.Graph()
+        with inference_graph.as_default():
+            inputs = tf.placeholder(tf.float32, [None, self.s_dim], name="inputs")
+            net = inputs
+            for W, b, gamma, beta, mean, variance in hidden_params:
+                # BN(x W + b) = x (W * scale) + (b - mean) * scale + beta, with tflearn's default epsilon
+                scale = gamma / np.sqrt(variance + 1e-5)
+                net = tf.nn.relu(tf.nn.bias_add(tf.matmul(net, W * scale), (b - mean) * scale + beta))
+            W, b = out_params
+            out = tf.tanh(tf.nn.bias_add(tf.matmul(net, W), b))
+            scaled_out = tf.multiply(out, np.asarray(self.action_bound, dtype=np.float32), name="scaled_out")
+
+        return inference_graph.as_graph_def(), inputs.op.name, scaled_out.op.name
+
+    def create_policy_update(self, q_value):
+        """
+        Build the optimization Op on the critic's Q(s, mu(s)) evaluated on this
+        actor's output, so the critic's action gradient flows into the actor
+        inside the graph and one sess.run updates the policy.
+        """
+        # Same gradient as -dQ/da * dmu/dtheta averaged over the minibatch
+        self.optimize = tf.train.AdamOptimizer(self.learning_rate).minimize(
+            -tf.reduce_mean(q_value), var_list=self.network_params
+        )
+        self._train_callable = make_session_callable(self.sess, [self.optimize], [self.inputs])
 
-    def predict_target(self, inputs):
-        return self.sess.run(self.target_scaled_out, feed_dict={self.target_inputs: inputs})
+    def train(self, inputs):
+        self._train_callable(inputs)
 
     def update_target_network(self):
-        self.sess.run(self.update_target_network_params)
+        self._update_target_callable()
 
     def get_num_trainable_vars(self):
         return self.num_trainable_vars
 
 
+class RolloutActor(object):
+    """
+    Frozen snapshot of the online actor, with batch norm folded away and
+    optionally INT8-quantized, loaded into its own session and used only to
+    sample rollouts. Training keeps updating the FP32 actor; call refresh()
+    to take a new snapshot of its weights.
+    """
+
+    def __init__(self, actor):
+        self.actor = actor
+        self.s_dim = actor.s_dim
+        self.a_dim = actor.a_dim
+        self.sess = None
+
+    def refresh(self, quantize=False):
+        graph_def, input_name, output_name = self.actor.export_inference_graph()
+        if quantize:
+            graph_def = TransformGraph(
+                graph_def,
+                [input_name],
+                [output_name],
+                ["quantize_weights", "quantize_nodes", "strip_unused_nodes"],
+            )
+
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+
+        # The weights are constants of the graph, so every refresh builds a new graph and
+        # session; this is intended, as refreshes only happen every few dozen env steps.
+        # One thread per pool is plenty for this small MLP and keeps the cores for the
+        # training session and the env workers.
+        self.close()
+        self.sess = tf.Session(
+            graph=graph, config=tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=1)
+        )
+        self._predict_callable = make_session_callable(
+            self.sess, [graph.get_tensor_by_name(output_name + ":0")], [graph.get_tensor_by_name(input_name + ":0")]
+        )
+
+    def predict(self, inputs):
+        return self._predict_callable(inputs)[0]
+
+    def close(self):
+        if self.sess is not None:
+            self.sess.close()
+            self.sess = None
+
+
 class CriticNetwork(object):
     """
     Input to the network is the state and action, output is Q(s,a).
     The action must be obtained from the output of the Actor network.
+    The target network takes its state and action directly from the
+    actor's target network, so the targets y_i are computed in-graph.
 
     """
 
-    def __init__(self, sess, state_dim, action_dim, learning_rate, tau, gamma, num_actor_vars):
+    def __init__(self, sess, state_dim, action_dim, learning_rate, tau, gamma, num_actor_vars, actor):
         self.sess = sess
         self.s_dim = state_dim
         self.a_dim = action_dim
@@ -126,76 +242,77 @@ class CriticNetwork(object):
         self.gamma = gamma
 
         # Create the critic network
-        self.inputs, self.action, self.out = self.create_critic_network()
+        self.inputs, self.action, self.out = self.create_critic_network("critic")
 
         self.network_params = tf.trainable_variables()[num_actor_vars:]
 
-        # Target Network
-        self.target_inputs, self.target_action, self.target_out = self.create_critic_network()
+        # Target Network, evaluated at (s2, actor_target(s2))
+        self.target_inputs, self.target_action, self.target_out = self.create_critic_network(
+            "target_critic", actor.target_inputs, actor.target_scaled_out
+        )
 
         self.target_network_params = tf.trainable_variables()[(len(self.network_params) + num_actor_vars) :]
 
+        # Q(s, mu(s)) of the online actor, sharing the online critic's variables
+        _, _, self.policy_q = self.create_critic_network("critic", actor.inputs, actor.scaled_out, reuse=True)
+
         # Op for periodically updating target network with online network
-        # weights with regularization
-        self.update_target_network_params = [
-            self.target_network_params[i].assign(
-                tf.multiply(self.network_params[i], self.tau)
-                + tf.multiply(self.target_network_params[i], 1.0 - self.tau)
-            )
-            for i in range(len(self.target_network_params))
-        ]
+        # weights with regularization, grouped so that it runs as a single fetch
+        self.update_target_network_params = tf.group(
+            *[
+                target_param.assign_sub(self.tau * (target_param - param))
+                for param, target_param in zip(self.network_params, self.target_network_params)
+            ]
+        )
 
-        # Network target (y_i)
-        self.predicted_q_value = tf.placeholder(tf.float32, [None, 1])
+        # Network target (y_i) = r + gamma * (1 - done) * Q'(s2, mu'(s2))
+        self.reward = tf.placeholder(tf.float32, [None, 1])
+        self.terminal = tf.placeholder(tf.float32, [None, 1])
+        self.target_q_value = self.reward + self.gamma * (1.0 - self.terminal) * self.target_out
 
         # Define loss and optimization Op
-        self.loss = tflearn.mean_square(self.predicted_q_value, self.out)
+        self.loss = tflearn.mean_square(tf.stop_gradient(self.target_q_value), self.out)
         self.optimize = tf.train.AdamOptimizer(self.learning_rate).minimize(self.loss)
 
-        # Get the gradient of the net w.r.t. the action.
-        # For each action in the minibatch (i.e., for each x in xs),
-        # this will sum up the gradients of each critic output in the minibatch
-        # w.r.t. that action. Each output is independent of all
-        # actions except for one.
-        self.action_grads = tf.gradients(self.out, self.action)
-
-    def create_critic_network(self):
-        inputs = tflearn.input_data(shape=[None, self.s_dim])
-        action = tflearn.input_data(shape=[None, self.a_dim])
-        net = tflearn.fully_connected(inputs, 400)
-        net = tflearn.layers.normalization.batch_normalization(net)
-        net = tflearn.activations.relu(net)
-
-        # Add the action tensor in the 2nd hidden layer
-        # Use two temp layers to get the corresponding weights and biases
-        t1 = tflearn.fully_connected(net, 300)
-        t2 = tflearn.fully_connected(action, 300)
-
-        net = tflearn.activation(tf.matmul(net, t1.W) + tf.matmul(action, t2.W) + t2.b, activation="relu")
-
-        # linear layer connected to 1 output representing Q(s,a)
-        # Weights are init to Uniform[-3e-3, 3e-3]
-        w_init = tflearn.initializations.uniform(minval=-0.003, maxval=0.003)
-        out = tflearn.fully_connected(net, 1, weights_init=w_init)
-        return inputs, action, out
-
-    def train(self, inputs, action, predicted_q_value):
-        return self.sess.run(
+        # Cached callables; make_callable takes the fast path only when nothing is fed
+        self._train_step_callable = make_session_callable(
+            self.sess,
             [self.out, self.optimize],
-            feed_dict={self.inputs: inputs, self.action: action, self.predicted_q_value: predicted_q_value},
+            [self.inputs, self.action, self.reward, self.terminal, self.target_inputs],
         )
+        self._update_target_callable = self.sess.make_callable(self.update_target_network_params)
+
+    def create_critic_network(self, scope, inputs=None, action=None, reuse=False):
+        if inputs is None:
+            inputs = tflearn.input_data(shape=[None, self.s_dim])
+        if action is None:
+            action = tflearn.input_data(shape=[None, self.a_dim])
+
+        # Named layers, so that the network can be rebuilt on other inputs with reuse=True
+        with tf.variable_scope(scope, reuse=reuse):
+            net = tflearn.fully_connected(inputs, 400, scope="fc1", reuse=reuse)
+            net = tflearn.layers.normalization.batch_normalization(net, scope="bn1", reuse=reuse)
+            net = tflearn.activations.relu(net)
+
+            # Add the action tensor in the 2nd hidden layer
+            # Use two temp layers to get the corresponding weights and biases
+            t1 = tflearn.fully_connected(net, 300, scope="t1", reuse=reuse)
+            t2 = tflearn.fully_connected(action, 300, scope="t2", reuse=reuse)
+
+            net = tflearn.activation(tf.matmul(net, t1.W) + tf.matmul(action, t2.W) + t2.b, activation="relu")
+
+            # linear layer connected to 1 output representing Q(s,a)
+            # Weights are init to Uniform[-3e-3, 3e-3]
+            w_init = tflearn.initializations.uniform(minval=-0.003, maxval=0.003)
+            out = tflearn.fully_connected(net, 1, weights_init=w_init, scope="out", reuse=reuse)
+        return inputs, action, out
 
-    def predict(self, inputs, action):
-        return self.sess.run(self.out, feed_dict={self.inputs: inputs, self.action: action})
-
-    def predict_target(self, inputs, action):
-        return self.sess.run(self.target_out, feed_dict={self.target_inputs: inputs, self.target_action: action})
-
-    def action_gradients(self, inputs, actions):
-        return self.sess.run(self.action_grads, feed_dict={self.inputs: inputs, self.action: actions})
+    def train_step(self, inputs, action, reward, terminal, next_inputs):
+        # Returns the predicted Q values of the minibatch
+        return self._train_step_callable(inputs, action, reward, terminal, next_inputs)[0]
 
     def update_target_network(self):
-        self.sess.run(self.update_target_network_params)
+        self._update_target_callable()
 
 
 # Taken from https://github.com/openai/baselines/blob/master/baselines/ddpg/noise.py, which is
@@ -210,16 +327,36 @@ class OrnsteinUhlenbeckActionNoise:
         self.reset()
 
     def __call__(self):
-        x = (
-            self.x_prev
-            + self.theta * (self.mu - self.x_prev) * self.dt
-            + self.sigma * np.sqrt(self.dt) * np.random.normal(size=self.mu.shape)
-        )
+        if self._idx < len(self._buf):
+            x = self._buf[self._idx]
+            self._idx += 1
+        else:
+            x = (
+                self.x_prev
+                + self.theta * (self.mu - self.x_prev) * self.dt
+                + self.sigma * np.sqrt(self.dt) * np.random.normal(size=self.mu.shape)
+            )
         self.x_prev = x
         return x
 
+    def prefill(self, T):
+        """
+        Pre-generate the next T samples of the process with a single draw
+        from the RNG; they are returned by the next T calls.
+        """
+        eps = self.sigma * np.sqrt(self.dt) * np.random.normal(size=(T,) + self.mu.shape)
+        buf = np.empty_like(eps)
+        x = self.x_prev
+        for t in range(T):
+            x = x + self.theta * (self.mu - x) * self.dt + eps[t]
+            buf[t] = x
+        self._buf = buf
+        self._idx = 0
+
     def reset(self):
         self.x_prev = self.x0 if self.x0 is not None else np.zeros_like(self.mu)
+        self._buf = np.empty((0,) + self.mu.shape)
+        self._idx = 0
 
     def __repr__(self):
         return "OrnsteinUhlenbeckActionNoise(mu={}, sigma={})".format(self.mu, self.sigma)
@@ -275,16 +412,99 @@ def arccs(sinth, costh):
     return th
 
 
-def is_in_constraint(s):
-    costh, sinth = s[0], s[1]
-    th = arccs(sinth, costh)
-    if np.abs(th) >= 1:
-        return False
-    else:
-        return True
+@njit(cache=True, fastmath=True)
+def arccs_scalar(sinth, costh):
+    # Scalar version of arccs; the arrays version is kept for offline analysis
+    th = math.acos(0.9999 * costh)
+    if sinth <= 0:
+        # Same as 2 * pi - th once wrapped into [-pi, pi)
+        th = -th
+    return ((th + math.pi) % (2 * math.pi)) - math.pi
+
+
+@njit(cache=True, fastmath=True)
+def is_in_constraint_nb(costh, sinth):
+    return abs(arccs_scalar(sinth, costh)) < 1.0
+
 
+# Number of env steps the collector caches locally before pushing them
+# into the shared replay buffer under one lock acquire
+REPLAY_BATCH_ADD = 32
 
-def train(sess, env, args, actor, critic, actor_noise, reward_result, agent):
+# Number of episodes between flushes of the TensorBoard event file
+SUMMARY_FLUSH_EVERY = 10
+
+
+def update_networks(actor, critic, replay_buffer, minibatch_size):
+    """
+    Run one DDPG update of the critic, actor and target networks on a sampled
+    minibatch. Returns the max predicted Q value of the minibatch.
+    """
+    s_batch, a_batch, r_batch, t_batch, s2_batch = replay_buffer.sample_batch(minibatch_size)
+
+    # Update the critic given the targets, which are computed in the same sess.run
+    predicted_q_value = critic.train_step(s_batch, a_batch, r_batch, t_batch, s2_batch)
+
+    # Update the actor policy through the critic's action gradient, in one sess.run
+    actor.train(s_batch)
+
+    # Update target networks
+    actor.update_target_network()
+    critic.update_target_network()
+
+    return np.amax(predicted_q_value)
+
+
+def train_worker(actor, critic, replay_buffer, minibatch_size, train_every, stop_event, stats):
+    """
+    Trainer thread: update the networks from the replay buffer until
+    stop_event is set. It shares the session with the sample-collection loop,
+    so the network updates overlap with env.step and the CBF QP solves.
+
+    One update is run for every train_every new transitions, on a minibatch
+    of train_every * minibatch_size samples. With train_every = 1 this is the
+    original one update per transition. Larger values are not equivalent:
+    both losses are batch means optimized with Adam and tau is unchanged, so
+    there is less learning per transition and the targets lag further.
+
+    The number of transitions trained on so far is kept in stats["consumed"]
+    across rollouts; once stopped, the trainer still runs the updates that
+    are pending and leaves only the remainder for the next rollout.
+    """
+    batch_size = train_every * minibatch_size
+    try:
+        while True:
+            # Block until the collector has pushed train_every new transitions,
+            # so the trainer never runs ahead of the samples
+            size, num_added = replay_buffer.wait_for_added(stats["consumed"] + train_every - 1, stop_event)
+
+            # Keep adding experience to the memory until
+            # there are more than batch_size samples
+            if size <= batch_size:
+                stats["consumed"] = num_added
+
+            if num_added - stats["consumed"] >= train_every:
+                stats["consumed"] += train_every
+                stats["ave_max_q"] += update_networks(actor, critic, replay_buffer, batch_size)
+                stats["iter"] += 1
+            elif stop_event.is_set():
+                break
+    except Exception as e:
+        stats["error"] = e
+
+
+def train(sess, venv, args, actor, critic, actor_noise, reward_result, agent):
+
+    # Parse the run parameters once, outside the training loops
+    max_episodes = int(args["max_episodes"])
+    max_episode_len = int(args["max_episode_len"])
+    minibatch_size = int(args["minibatch_size"])
+    train_every = int(args["train_every"])
+    buffer_size = int(args["buffer_size"])
+    random_seed = int(args["random_seed"])
+    int8_warmup = int(args["int8_warmup"])
+    actor_refresh_every = int(args["actor_refresh_every"])
+    gp_max_points = int(args["gp_max_points"])
 
     # Set up summary Ops
     summary_ops, summary_vars = build_summaries()
@@ -297,7 +517,7 @@ def train(sess, env, args, actor, critic, actor_noise, reward_result, agent):
     critic.update_target_network()
 
     # Initialize replay memory
-    replay_buffer = ReplayBuffer(int(args["buffer_size"]), int(args["random_seed"]))
+    replay_buffer = ReplayBuffer(buffer_size, actor.s_dim, actor.a_dim, random_seed)
 
     # Needed to enable BatchNorm.
     # This hurts the performance on Pendulum but could be useful
@@ -307,8 +527,25 @@ def train(sess, env, args, actor, critic, actor_noise, reward_result, agent):
     counter_iter = 0
     counter_cvt = 0
     paths = list()
+    num_envs = venv.num_envs
+    rollout_actor = RolloutActor(actor)
+
+    # Local cache of transitions, one row per env step, flushed into the replay buffer in chunks
+    cache_s = np.empty((REPLAY_BATCH_ADD, num_envs, actor.s_dim), dtype=np.float32)
+    cache_a = np.empty((REPLAY_BATCH_ADD, num_envs, actor.a_dim), dtype=np.float32)
+    cache_r = np.empty((REPLAY_BATCH_ADD, num_envs), dtype=np.float32)
+    cache_t = np.empty((REPLAY_BATCH_ADD, num_envs), dtype=np.float32)
+    cache_s2 = np.empty((REPLAY_BATCH_ADD, num_envs, actor.s_dim), dtype=np.float32)
+
+    # Per-step buffers reused across steps instead of allocating fresh arrays
+    state_buf = np.empty((num_envs, actor.s_dim), dtype=np.float32)
+    action_buf = np.empty((num_envs, actor.a_dim), dtype=np.float32)
+    no_compensation = np.zeros((num_envs, actor.a_dim))
 
-    for i in range(int(args["max_episodes"])):
+    # Trainer progress, kept across rollouts so that no pending update is dropped
+    stats = {"consumed": 0, "ave_max_q": 0.0, "iter": 0, "error": None}
+
+    for i in range(max_episodes):
 
         # Utilize GP from previous iteration while training current iteration
         if agent.firstIter == 1:
@@ -319,132 +556,147 @@ def train(sess, env, args, actor, critic, actor_noise, reward_result, agent):
 
         for el in range(5):
 
-            obs, action, rewards, action_bar, action_BAR = [], [], [], [], []
-
-            s = env.reset()
-            # Ensure that starting position is in "safe" region
-            while env.unwrapped.state[0] > 0.8 or env.unwrapped.state[0] < -0.8:
-                s = env.reset()
-
-            ep_reward = 0
-            ep_ave_max_q = 0
-
-            for j in range(int(args["max_episode_len"])):
-
-                # env.render()
-
-                # Added exploration noise
-                # a = actor.predict(np.reshape(s, (1, 3))) + (1. / (1. + i))
-                a = actor.predict(np.reshape(s, (1, actor.s_dim))) + actor_noise()
-
-                # Incorporate barrier function
-                action_rl = a[0]
-
-                # Utilize compensation barrier function
-                if agent.firstIter == 1:
-                    u_BAR_ = [0]
-                else:
-                    u_BAR_ = agent.bar_comp.get_action(s)[0]
-
-                action_RL = action_rl + u_BAR_
-
-                # Utilize safety barrier function
-                if agent.firstIter == 1:
-                    [f, g, x, std] = dynamics_gp.get_GP_dynamics(agent, s, action_RL)
-                else:
-                    [f, g, x, std] = dynamics_gp.get_GP_dynamics_prev(agent, s, action_RL)
-                u_bar_ = cbf.control_barrier(agent, np.squeeze(s), action_RL, f, g, x, std)
-                action_ = action_RL + u_bar_
-
-                s2, r, terminal, info = env.step(action_)
-                counter_step += 1
-                if not is_in_constraint(s2):
-                    counter_cvt += 1
-                replay_buffer.add(
-                    np.reshape(s, (actor.s_dim,)),
-                    np.reshape(a, (actor.a_dim,)),
-                    r,
-                    terminal,
-                    np.reshape(s2, (actor.s_dim,)),
+            # Rollout storage, one row per env with time along the second axis
+            obs = np.empty((num_envs, max_episode_len, actor.s_dim), dtype=np.float32)
+            action = np.empty((num_envs, max_episode_len, actor.a_dim), dtype=np.float32)
+            action_bar = np.empty((num_envs, max_episode_len, actor.a_dim), dtype=np.float32)
+            action_BAR = np.empty((num_envs, max_episode_len, actor.a_dim), dtype=np.float32)
+            rewards = np.empty((num_envs, max_episode_len), dtype=np.float32)
+            n_cached = 0
+
+            state_buf[:] = venv.reset()
+            actor_noise.prefill(max_episode_len)
+
+            ep_reward = np.zeros(num_envs)
+
+            # Network updates run in their own thread while this one collects samples
+            stats.update(ave_max_q=0.0, iter=0)
+            stop_event = threading.Event()
+            trainer = threading.Thread(
+                target=train_worker,
+                args=(
+                    actor,
+                    critic,
+                    replay_buffer,
+                    minibatch_size,
+                    train_every,
+                    stop_event,
+                    stats,
+                ),
+            )
+            trainer.daemon = True
+            trainer.start()
+
+            try:
+                for j in range(max_episode_len):
+
+                    # Sample with a snapshot of the actor with batch norm folded away, taken every
+                    # actor_refresh_every steps and quantized to INT8 once the weights have settled
+                    if j % actor_refresh_every == 0:
+                        rollout_actor.refresh(quantize=0 <= int8_warmup <= i)
+
+                    # Added exploration noise, one actor pass for all envs
+                    a = np.add(rollout_actor.predict(state_buf), actor_noise(), out=action_buf)
+
+                    # Utilize compensation barrier function
+                    if agent.firstIter == 1:
+                        u_BAR_ = no_compensation
+                    else:
+                        u_BAR_ = agent.bar_comp.get_action(state_buf)
+
+                    action_RL = a + u_BAR_
+
+                    # GP dynamics of all envs in one batched query per GP model
+                    if agent.firstIter == 1:
+                        [f, g, x, std] = dynamics_gp.get_GP_dynamics(agent, state_buf, action_RL)
+                    else:
+                        [f, g, x, std] = dynamics_gp.get_GP_dynamics_prev(agent, state_buf, action_RL)
+
+                    # The safety barrier function is solved inside each env worker
+                    s2, r, terminal, info = venv.step(action_RL, f, g, x, std)
+                    u_bar_ = np.stack([inf["u_bar"] for inf in info])
+                    action_ = np.stack([inf["action"] for inf in info])
+
+                    counter_step += num_envs
+                    for k in range(num_envs):
+                        if not is_in_constraint_nb(s2[k, 0], s2[k, 1]):
+                            counter_cvt += 1
+
+                    cache_s[n_cached] = state_buf
+                    cache_a[n_cached] = a
+                    cache_r[n_cached] = r
+                    cache_t[n_cached] = terminal
+                    cache_s2[n_cached] = s2
+                    n_cached += 1
+
+                    # Flush when the cache is full and at the end of the rollout
+                    if n_cached == REPLAY_BATCH_ADD or terminal.any() or j == max_episode_len - 1:
+                        replay_buffer.extend(
+                            cache_s[:n_cached].reshape((-1, actor.s_dim)),
+                            cache_a[:n_cached].reshape((-1, actor.a_dim)),
+                            cache_r[:n_cached].reshape(-1),
+                            cache_t[:n_cached].reshape(-1),
+                            cache_s2[:n_cached].reshape((-1, actor.s_dim)),
+                        )
+                        n_cached = 0
+
+                    state_buf[:] = s2
+                    ep_reward += r
+
+                    obs[:, j] = state_buf
+                    rewards[:, j] = r
+                    action_bar[:, j] = u_bar_
+                    action_BAR[:, j] = u_BAR_
+                    action[:, j] = action_
+
+                    if terminal.any():
+                        break
+            finally:
+                # Stop the trainer at the end of the episode, once it has run the pending updates
+                stop_event.set()
+                replay_buffer.wake()
+                trainer.join()
+
+            if stats["error"] is not None:
+                raise stats["error"]
+
+            counter_iter += stats["iter"]
+            ep_ave_max_q = stats["ave_max_q"] / float(max(stats["iter"], 1))
+
+            if terminal.any():
+                summary_str = sess.run(
+                    summary_ops,
+                    feed_dict={
+                        summary_vars[0]: np.mean(ep_reward),
+                        summary_vars[1]: ep_ave_max_q,
+                        summary_vars[2]: counter_step,
+                        summary_vars[3]: counter_iter,
+                        summary_vars[4]: counter_cvt,
+                    },
                 )
 
-                # replay_buffer.add(np.reshape(s, (actor.s_dim,)), np.reshape(action_, (actor.a_dim,)), r,
-                #                  terminal, np.reshape(s2, (actor.s_dim,)))
-
-                # Keep adding experience to the memory until
-                # there are at least minibatch size samples
-                if replay_buffer.size() > int(args["minibatch_size"]):
-                    s_batch, a_batch, r_batch, t_batch, s2_batch = replay_buffer.sample_batch(
-                        int(args["minibatch_size"])
-                    )
-
-                    # Calculate targets
-                    target_q = critic.predict_target(s2_batch, actor.predict_target(s2_batch))
-
-                    y_i = []
-                    for k in range(int(args["minibatch_size"])):
-                        if t_batch[k]:
-                            y_i.append(r_batch[k])
-                        else:
-                            y_i.append(r_batch[k] + critic.gamma * target_q[k])
-
-                    # Update the critic given the targets
-                    predicted_q_value, _ = critic.train(
-                        s_batch, a_batch, np.reshape(y_i, (int(args["minibatch_size"]), 1))
-                    )
-
-                    ep_ave_max_q += np.amax(predicted_q_value)
-
-                    # Update the actor policy using the sampled gradient
-                    a_outs = actor.predict(s_batch)
-                    grads = critic.action_gradients(s_batch, a_outs)
-                    actor.train(s_batch, grads[0])
-                    counter_iter += 1
-                    # Update target networks
-                    actor.update_target_network()
-                    critic.update_target_network()
-
-                s = s2
-                ep_reward += r
-
-                obs.append(s)
-                rewards.append(r)
-                action_bar.append(u_bar_)
-                action_BAR.append(u_BAR_)
-                action.append(action_)
-
-                if terminal:
-                    summary_str = sess.run(
-                        summary_ops,
-                        feed_dict={
-                            summary_vars[0]: ep_reward,
-                            summary_vars[1]: ep_ave_max_q / float(j),
-                            summary_vars[2]: counter_step,
-                            summary_vars[3]: counter_iter,
-                            summary_vars[4]: counter_cvt,
-                        },
-                    )
-
-                    writer.add_summary(summary_str, counter_iter)
-                    writer.flush()
-
-                    print(
-                        "| Reward: {:d} | Episode: {:d} | Qmax: {:.4f}".format(
-                            int(ep_reward), i, (ep_ave_max_q / float(j))
-                        )
-                    )
-                    reward_result[i] = ep_reward
-                    path = {
-                        "Observation": np.concatenate(obs).reshape((200, 3)),
-                        "Action": np.concatenate(action),
-                        "Action_bar": np.concatenate(action_bar),
-                        "Action_BAR": np.concatenate(action_BAR),
-                        "Reward": np.asarray(rewards),
+                # Queued in memory, written out every SUMMARY_FLUSH_EVERY episodes
+                writer.add_summary(summary_str, counter_iter)
+
+                print(
+                    "| Reward: {:d} | Episode: {:d} | Qmax: {:.4f}".format(int(np.mean(ep_reward)), i, ep_ave_max_q)
+                )
+                reward_result[i] = np.mean(ep_reward)
+
+                # One path per env
+                rollout_paths = [
+                    {
+                        "Observation": obs[k, : j + 1],
+                        "Action": action[k, : j + 1].reshape(-1),
+                        "Action_bar": action_bar[k, : j + 1].reshape(-1),
+                        "Action_BAR": action_BAR[k, : j + 1].reshape(-1),
+                        "Reward": rewards[k, : j + 1],
                     }
-                    paths.append(path)
-                    break
+                    for k in range(num_envs)
+                ]
+                paths.extend(rollout_paths)
             if el <= 3:
-                dynamics_gp.update_GP_dynamics(agent, path)
+                dynamics_gp.update_GP_dynamics(agent, rollout_paths, gp_max_points)
 
         if i <= 4:
             agent.bar_comp.get_training_rollouts(paths)
@@ -453,26 +705,84 @@ def train(sess, env, args, actor, critic, actor_noise, reward_result, agent):
             barr_loss = 0.0
         agent.firstIter = 0
 
+        if (i + 1) % SUMMARY_FLUSH_EVERY == 0:
+            writer.flush()
+
+    writer.close()
+    rollout_actor.close()
+
     return [summary_ops, summary_vars, paths]
 
 
+def make_env(env_id, seed):
+    """
+    Build the gym env with the pendulum torque and speed limits used by DDPG-CBF
+    """
+    env = gym.make(env_id)
+    env.seed(seed)
+
+    # Set environment parameters for pendulum
+    env.unwrapped.max_torque = 15.0
+    env.unwrapped.max_speed = 60.0
+    env.unwrapped.action_space = spaces.Box(low=-env.unwrapped.max_torque, high=env.unwrapped.max_torque, shape=(1,))
+    high = np.array([1.0, 1.0, env.unwrapped.max_speed])
+    env.unwrapped.observation_space = spaces.Box(low=-high, high=high)
+    return env
+
+
+def physical_cpu_count():
+    """
+    Number of physical cores, read from /proc/cpuinfo on Linux; falls back
+    to the logical CPU count elsewhere
+    """
+    cores = set()
+    try:
+        with open("/proc/cpuinfo") as f:
+            physical_id = None
+            for line in f:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                if key == "physical id":
+                    physical_id = value.strip()
+                elif key == "core id":
+                    cores.add((physical_id, value.strip()))
+    except OSError:
+        pass
+    return len(cores) or os.cpu_count() or 1
+
+
+def build_session_config(num_envs, intra_op_threads=0):
+    """
+    Session config with XLA JIT turned on and the thread pools sized for the
+    small actor/critic MLPs, where per-op overhead dominates. Unless
+    intra_op_threads is given, the intra-op pool gets the physical cores
+    that are not taken by the num_envs env worker processes.
+    """
+    if intra_op_threads <= 0:
+        intra_op_threads = max(1, physical_cpu_count() - num_envs)
+    config = tf.ConfigProto()
+    config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    config.intra_op_parallelism_threads = intra_op_threads
+    config.inter_op_parallelism_threads = 2
+    return config
+
+
 def main(args, reward_result):
 
-    with tf.Session() as sess:
+    # Fork the env workers before the session starts its thread pools
+    num_envs = int(args["num_envs"])
+    venv = SubprocVecEnv(
+        [functools.partial(make_env, args["env"], int(args["random_seed"]) + k) for k in range(num_envs)]
+    )
+
+    # Give the GPU its own launch threads when one is used
+    os.environ.setdefault("TF_GPU_THREAD_MODE", "gpu_private")
+
+    with tf.Session(config=build_session_config(num_envs, int(args["intra_op_threads"]))) as sess:
 
-        env = gym.make(args["env"])
+        env = make_env(args["env"], int(args["random_seed"]))
         np.random.seed(int(args["random_seed"]))
         tf.set_random_seed(int(args["random_seed"]))
-        env.seed(int(args["random_seed"]))
-
-        # Set environment parameters for pendulum
-        env.unwrapped.max_torque = 15.0
-        env.unwrapped.max_speed = 60.0
-        env.unwrapped.action_space = spaces.Box(
-            low=-env.unwrapped.max_torque, high=env.unwrapped.max_torque, shape=(1,)
-        )
-        high = np.array([1.0, 1.0, env.unwrapped.max_speed])
-        env.unwrapped.observation_space = spaces.Box(low=-high, high=high)
 
         state_dim = env.observation_space.shape[0]
         action_dim = env.action_space.shape[0]
@@ -487,7 +797,6 @@ def main(args, reward_result):
             action_bound,
             float(args["actor_lr"]),
             float(args["tau"]),
-            int(args["minibatch_size"]),
         )
 
         critic = CriticNetwork(
@@ -498,16 +807,19 @@ def main(args, reward_result):
             float(args["tau"]),
             float(args["gamma"]),
             actor.get_num_trainable_vars(),
+            actor,
         )
+        actor.create_policy_update(critic.policy_q)
 
-        actor_noise = OrnsteinUhlenbeckActionNoise(mu=np.zeros(action_dim))
+        actor_noise = OrnsteinUhlenbeckActionNoise(mu=np.zeros((num_envs, action_dim)))
 
         agent = LEARNER(env)
         cbf.build_barrier(agent)
         dynamics_gp.build_GP_model(agent)
         agent.bar_comp = BARRIER(sess, 3, 1)
 
-        [summary_ops, summary_vars, paths] = train(sess, env, args, actor, critic, actor_noise, reward_result, agent)
+        [summary_ops, summary_vars, paths] = train(sess, venv, args, actor, critic, actor_noise, reward_result, agent)
+        venv.close()
 
         return [summary_ops, summary_vars, paths]
 
@@ -522,12 +834,28 @@ if __name__ == "__main__":
     parser.add_argument("--tau", help="soft target update parameter", default=0.001)
     parser.add_argument("--buffer-size", help="max size of the replay buffer", default=1000000)
     parser.add_argument("--minibatch-size", help="size of minibatch for minibatch-SGD", default=64)
+    parser.add_argument(
+        "--train-every", help="new transitions per update, each on train-every minibatches of samples", default=1
+    )
 
     # run parameters
     parser.add_argument("--env", help="choose the gym env- tested on {Pendulum-v0}", default="Pendulum-v0")
     parser.add_argument("--random-seed", help="random seed for repeatability", default=1234)
     parser.add_argument("--max-episodes", help="max num of episodes to do while training", default=150)
     parser.add_argument("--max-episode-len", help="max length of 1 episode", default=200)
+    parser.add_argument("--num-envs", help="number of envs stepped in parallel worker processes", default=1)
+    parser.add_argument(
+        "--gp-max-points", help="max rows the GP dynamics are refit on (0 uses every env's path)", default=200
+    )
+    parser.add_argument(
+        "--intra-op-threads", help="TF intra-op threads (0 uses the physical cores left by the envs)", default=0
+    )
+    parser.add_argument(
+        "--actor-refresh-every", help="env steps between snapshots of the actor used for rollouts", default=50
+    )
+    parser.add_argument(
+        "--int8-warmup", help="episodes before rollouts use an INT8-quantized actor (-1 disables)", default=-1
+    )
     parser.add_argument("--render-env", help="render the gym env", action="store_false")
     parser.add_argument("--use-gym-monitor", help="record gym results", action="store_false")
     parser.add_argument("--monitor-dir", help="directory for storing gym results", default="./results/gym_ddpg")
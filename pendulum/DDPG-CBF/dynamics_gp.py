@@ -29,65 +29,70 @@ def build_GP_model(self):
 
 
 # Get the dynamics of the system from the current time step with the RL action
+# obs may be a single observation [3] or a batch [batch size, 3]
 def get_dynamics(self, obs, u_rl):
     dt = 0.05
     G = 10
     m = 1.4
     l = 1.4
-    obs = np.squeeze(obs)
-    theta = np.arctan2(obs[1], obs[0])
-    theta_dot = obs[2]
-    f = np.array(
+    obs = np.asarray(obs)
+    theta = np.arctan2(obs[..., 1], obs[..., 0])
+    theta_dot = obs[..., 2]
+    u_rl = np.reshape(u_rl, np.shape(theta))
+    f = np.stack(
         [
             -3 * G / (2 * l) * np.sin(theta + np.pi) * dt**2
             + theta_dot * dt
             + theta
             + 3 / (m * l**2) * u_rl * dt**2,
             theta_dot - 3 * G / (2 * l) * np.sin(theta + np.pi) * dt + 3 / (m * l**2) * u_rl * dt,
-        ]
+        ],
+        axis=-1,
     )
     g = np.array([3 / (m * l**2) * dt**2, 3 / (m * l**2) * dt])
 
-    x = np.array([theta, theta_dot])
-    return [np.squeeze(f), np.squeeze(g), np.squeeze(x)]
+    x = np.stack([theta, theta_dot], axis=-1)
+    return [f, g, x]
 
 
-# Build barrier function model
-def update_GP_dynamics(self, path):
-    N = self.observation_size
-    X = path["Observation"]
-    X = X.reshape((200, 3))
-    U = path["Action"]
-    L = X.shape[0]
-    err = np.zeros((L - 1, N - 1))
-    S = np.zeros((L - 1, 2))
-    for i in range(L - 1):
-        [f, g, x1] = get_dynamics(self, X[i, :], U[i])
-        theta_p = np.arctan2(X[i, 1], X[i, 0])
-        theta_dot_p = X[i, 2]
-        theta = np.arctan2(X[i + 1, 1], X[i + 1, 0])
-        theta_dot = X[i + 1, 2]
-        S[i, :] = np.array([theta_p, theta_dot_p])
-        err[i, :] = np.array([theta, theta_dot]) - f
+# Fit the GP models to the error of the nominal dynamics on a list of rollout paths,
+# subsampled to at most max_points rows since each fit is cubic in the number of rows
+def update_GP_dynamics(self, paths, max_points=200):
+    S = []
+    err = []
+    for path in paths:
+        X = np.reshape(path["Observation"], (-1, 3))
+        U = np.reshape(path["Action"], (-1,))
+        # One batched nominal prediction per path instead of one per step
+        [f, g, x] = get_dynamics(self, X[:-1], U[:-1])
+        x_next = np.stack([np.arctan2(X[1:, 1], X[1:, 0]), X[1:, 2]], axis=1)
+        S.append(x)
+        err.append(x_next - f)
+    S = np.concatenate(S)
+    err = np.concatenate(err)
+    if max_points > 0 and len(S) > max_points:
+        rows = np.random.choice(len(S), max_points, replace=False)
+        S = S[rows]
+        err = err[rows]
     self.GP_model[0].fit(S, err[:, 0])
     self.GP_model[1].fit(S, err[:, 1])
 
 
+# Dynamics with the GP correction for a batch of observations [batch size, 3] and RL actions [batch size, 1]
+# Returns f, x, std of shape [batch size, 2] and g of shape [2]
+def predict_GP_dynamics(self, GP_model, obs, u_rl):
+    obs = np.reshape(obs, (-1, 3))
+    [f_nom, g, x] = get_dynamics(self, obs, np.reshape(u_rl, (-1,)))
+    # One query per GP covers the whole batch, using the Cholesky factor cached at fit time
+    [m1, std1] = GP_model[0].predict(x, return_std=True)
+    [m2, std2] = GP_model[1].predict(x, return_std=True)
+    f = f_nom + np.stack([m1, m2], axis=1)
+    return [f, g, x, np.stack([std1, std2], axis=1)]
+
+
 def get_GP_dynamics(self, obs, u_rl):
-    [f_nom, g, x] = get_dynamics(self, obs, u_rl)
-    f = np.zeros(2)
-    [m1, std1] = self.GP_model[0].predict(x.reshape(1, -1), return_std=True)
-    [m2, std2] = self.GP_model[1].predict(x.reshape(1, -1), return_std=True)
-    f[0] = f_nom[0] + self.GP_model[0].predict(x.reshape(1, -1))
-    f[1] = f_nom[1] + self.GP_model[1].predict(x.reshape(1, -1))
-    return [np.squeeze(f), np.squeeze(g), np.squeeze(x), np.array([np.squeeze(std1), np.squeeze(std2)])]
+    return predict_GP_dynamics(self, self.GP_model, obs, u_rl)
 
 
 def get_GP_dynamics_prev(self, obs, u_rl):
-    [f_nom, g, x] = get_dynamics(self, obs, u_rl)
-    f = np.zeros(2)
-    [m1, std1] = self.GP_model_prev[0].predict(x.reshape(1, -1), return_std=True)
-    [m2, std2] = self.GP_model_prev[1].predict(x.reshape(1, -1), return_std=True)
-    f[0] = f_nom[0] + self.GP_model_prev[0].predict(x.reshape(1, -1))
-    f[1] = f_nom[1] + self.GP_model_prev[1].predict(x.reshape(1, -1))
-    return [np.squeeze(f), np.squeeze(g), np.squeeze(x), np.array([np.squeeze(std1), np.squeeze(std2)])]
+    return predict_GP_dynamics(self, self.GP_model_prev, obs, u_rl)
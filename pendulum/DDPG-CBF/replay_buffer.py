@@ -4,49 +4,104 @@ Data structure for implementing experience replay
 Author: Patrick Emami
 """
 import random
-from collections import deque
+import threading
 
 import numpy as np
 
 
 class ReplayBuffer(object):
-    def __init__(self, buffer_size, random_seed=123):
+    def __init__(self, buffer_size, state_dim, action_dim, random_seed=123):
         """
-        The right side of the deque contains the most recent experiences
+        Experiences are stored in preallocated ring-buffer arrays, one per
+        field; self.idx is the slot the next experience is written to
         """
         self.buffer_size = buffer_size
         self.count = 0
-        self.buffer = deque()
+        self.idx = 0
+        # Total number of experiences ever added, including overwritten ones
+        self.num_added = 0
+        self.s = np.empty((buffer_size, state_dim), dtype=np.float32)
+        self.a = np.empty((buffer_size, action_dim), dtype=np.float32)
+        self.r = np.empty((buffer_size, 1), dtype=np.float32)
+        self.t = np.empty((buffer_size, 1), dtype=np.float32)
+        self.s2 = np.empty((buffer_size, state_dim), dtype=np.float32)
+        # Guards the arrays when a collector and a trainer thread share the buffer
+        self.lock = threading.Lock()
+        # Notified whenever experiences are added, so a trainer can wait for new ones
+        self.added = threading.Condition(self.lock)
         random.seed(random_seed)
 
     def add(self, s, a, r, t, s2):
-        experience = (s, a, r, t, s2)
-        if self.count < self.buffer_size:
-            self.buffer.append(experience)
-            self.count += 1
-        else:
-            self.buffer.popleft()
-            self.buffer.append(experience)
+        with self.lock:
+            self._append(s, a, r, t, s2)
+            self.added.notify_all()
+
+    def extend(self, s, a, r, t, s2):
+        """
+        Add n experiences given as arrays with n rows, copied into the
+        ring buffer under a single lock acquire
+        """
+        n = len(s)
+        with self.lock:
+            first = min(n, self.buffer_size - self.idx)
+            for buf, val in ((self.s, s), (self.a, a), (self.r, r), (self.t, t), (self.s2, s2)):
+                val = np.reshape(val, (n, -1))
+                # Wrap around the end of the ring buffer
+                np.copyto(buf[self.idx : self.idx + first], val[:first])
+                np.copyto(buf[: n - first], val[first:])
+            self.idx = (self.idx + n) % self.buffer_size
+            self.count = min(self.count + n, self.buffer_size)
+            self.num_added += n
+            self.added.notify_all()
+
+    def _append(self, s, a, r, t, s2):
+        i = self.idx
+        self.s[i] = s
+        self.a[i] = a
+        self.r[i] = r
+        self.t[i] = t
+        self.s2[i] = s2
+        self.idx = (i + 1) % self.buffer_size
+        self.count = min(self.count + 1, self.buffer_size)
+        self.num_added += 1
 
     def size(self):
         return self.count
 
-    def sample_batch(self, batch_size):
-        batch = []
+    def wait_for_added(self, num_added, stop_event):
+        """
+        Block until more than num_added experiences have ever been added or
+        stop_event is set. Returns the current (size, num_added).
+        """
+        with self.added:
+            while self.num_added <= num_added and not stop_event.is_set():
+                self.added.wait()
+            return self.count, self.num_added
 
-        if self.count < batch_size:
-            batch = random.sample(self.buffer, self.count)
-        else:
-            batch = random.sample(self.buffer, batch_size)
+    def wake(self):
+        """
+        Wake up threads blocked in wait_for_added, e.g. after setting their stop_event
+        """
+        with self.added:
+            self.added.notify_all()
 
-        s_batch = np.array([_[0] for _ in batch])
-        a_batch = np.array([_[1] for _ in batch])
-        r_batch = np.array([_[2] for _ in batch])
-        t_batch = np.array([_[3] for _ in batch])
-        s2_batch = np.array([_[4] for _ in batch])
+    def sample_batch(self, batch_size):
+        """
+        Returns float32 arrays of shape (batch, dim); rewards and terminal
+        flags have shape (batch, 1)
+        """
+        with self.lock:
+            batch = random.sample(range(self.count), min(self.count, batch_size))
+
+            s_batch = self.s[batch]
+            a_batch = self.a[batch]
+            r_batch = self.r[batch]
+            t_batch = self.t[batch]
+            s2_batch = self.s2[batch]
 
         return s_batch, a_batch, r_batch, t_batch, s2_batch
 
     def clear(self):
-        self.buffer.clear()
-        self.count = 0
+        with self.lock:
+            self.count = 0
+            self.idx = 0
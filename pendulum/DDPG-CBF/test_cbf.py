@@ -0,0 +1,48 @@
+"""
+Check the warm-started OSQP solve of the CBF QP against the cvxopt solution
+on sampled pendulum states, GP corrections and RL actions
+"""
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip("osqp")
+pytest.importorskip("cvxopt")
+pytest.importorskip("sklearn")
+
+import cbf  # noqa: E402
+import dynamics_gp  # noqa: E402
+from vec_env import SafetyFilter  # noqa: E402
+
+
+def make_filter():
+    env = types.SimpleNamespace(
+        action_space=types.SimpleNamespace(shape=(1,)),
+        unwrapped=types.SimpleNamespace(max_torque=15.0, max_speed=60.0),
+    )
+    return SafetyFilter(env)
+
+
+def test_osqp_matches_cvxopt():
+    rng = np.random.RandomState(0)
+    # One filter for all samples, so the OSQP problem is warm-started as in a rollout
+    agent = make_filter()
+    for _ in range(500):
+        # Cover states inside and just outside the safe set, where the barrier is active
+        theta = rng.uniform(-1.2, 1.2)
+        theta_dot = rng.uniform(-3.0, 3.0)
+        obs = np.array([np.cos(theta), np.sin(theta), theta_dot])
+        u_rl = rng.uniform(-15.0, 15.0, size=(1,))
+
+        [f, g, x] = dynamics_gp.get_dynamics(agent, obs, u_rl)
+        f = f + rng.normal(scale=0.01, size=2)
+        std = rng.uniform(0.0, 0.05, size=2)
+
+        G, h = cbf.barrier_constraints(agent, u_rl, f, g, x, std)
+        expected = cbf.solve_barrier_qp_cvxopt(agent, G, h)[0]
+        expected = np.clip(u_rl[0] + expected, -agent.torque_bound, agent.torque_bound) - u_rl[0]
+
+        u_bar = cbf.control_barrier(agent, obs, u_rl, f, g, x, std)
+        assert u_bar.shape == (1,)
+        np.testing.assert_allclose(u_bar[0], expected, atol=1e-3)
@@ -0,0 +1,113 @@
+"""
+Vectorized Pendulum environments for DDPG-CBF. Each env runs in its own worker
+process together with its own CBF QP, so the safety filter of every env is
+solved in parallel. The GP dynamics of all envs are predicted in one batch
+by the caller and passed to step().
+
+Based on SubprocVecEnv from https://github.com/openai/baselines
+"""
+import multiprocessing as mp
+
+import cbf
+import numpy as np
+
+
+class SafetyFilter(object):
+    """
+    The attributes cbf.control_barrier needs, without the GP models and
+    the rest of LEARNER; the GP dynamics are passed in by the caller
+    """
+
+    def __init__(self, env):
+        self.action_size = env.action_space.shape[0]
+        self.torque_bound = env.unwrapped.max_torque
+        self.max_speed = env.unwrapped.max_speed
+        cbf.build_barrier(self)
+
+
+def worker(remote, parent_remote, env_fn):
+    parent_remote.close()
+    env = env_fn()
+    agent = SafetyFilter(env)
+    s = None
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                [action_RL, f, g, x, std] = data
+
+                # Utilize safety barrier function
+                u_bar_ = cbf.control_barrier(agent, np.squeeze(s), action_RL, f, g, x, std)
+                action_ = action_RL + u_bar_
+
+                s, r, terminal, info = env.step(action_)
+                info = dict(info, u_bar=u_bar_, action=action_)
+                remote.send((s, r, terminal, info))
+            elif cmd == "reset":
+                env.reset()
+                # Sample the starting state directly from the "safe" region
+                pendulum = env.unwrapped
+                pendulum.state = pendulum.np_random.uniform(low=[-0.8, -1.0], high=[0.8, 1.0])
+                s = pendulum._get_obs()
+                remote.send(s)
+            elif cmd == "close":
+                break
+            else:
+                raise NotImplementedError(cmd)
+    finally:
+        env.close()
+        remote.close()
+
+
+class SubprocVecEnv(object):
+    """
+    Steps a list of envs in worker processes. step() takes the RL action
+    (with barrier compensation) of every env and the batched GP dynamics
+    f, g, x, std from dynamics_gp, applies the CBF safety filter in the
+    workers, and returns the stacked (s2, r, done, info). The filtered
+    action and the CBF correction of each env are returned in
+    info["action"] and info["u_bar"].
+    """
+
+    def __init__(self, env_fns):
+        self.num_envs = len(env_fns)
+        # Fork so that the env constructors do not need to be pickled
+        ctx = mp.get_context("fork")
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(self.num_envs)])
+        self.ps = [
+            ctx.Process(target=worker, args=(work_remote, remote, env_fn))
+            for (work_remote, remote, env_fn) in zip(self.work_remotes, self.remotes, env_fns)
+        ]
+        for p in self.ps:
+            # If the main process crashes, we should not cause things to hang
+            p.daemon = True
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+        self.closed = False
+
+    def step(self, actions, f, g, x, std):
+        for k, remote in enumerate(self.remotes):
+            remote.send(("step", [actions[k], f[k], g, x[k], std[k]]))
+        results = [remote.recv() for remote in self.remotes]
+        obs, rews, dones, infos = zip(*results)
+        return (
+            np.stack(obs).reshape((self.num_envs, -1)),
+            np.array(rews, dtype=np.float64).reshape((self.num_envs,)),
+            np.array(dones, dtype=bool),
+            infos,
+        )
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        return np.stack([remote.recv() for remote in self.remotes]).reshape((self.num_envs, -1))
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for p in self.ps:
+            p.join()
+        self.closed = True